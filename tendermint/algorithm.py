@@ -1,11 +1,59 @@
-import time
-import zlib
 import string
 import random
-from collections import Counter, defaultdict
+import functools
+import itertools
+import collections
+import enum
+
+try:
+    from .messages import (
+        Proposal,
+        Prevote,
+        Precommit,
+        ProposalTimeout,
+        PrevoteTimeout,
+        PrecommitTimeout,
+        Batch,
+    )
+except ImportError:
+    # Running one of the run_*.py scripts, which puts tendermint/ on the path
+    from messages import (
+        Proposal,
+        Prevote,
+        Precommit,
+        ProposalTimeout,
+        PrevoteTimeout,
+        PrecommitTimeout,
+        Batch,
+    )
 
 
 NIL = None
+# Marks a node we have no vote from yet, as opposed to a vote for NIL
+NO_VOTE = object()
+
+# How many heights below our current one we keep proposals and votes for.
+# Anything older can no longer affect a decision
+KEEP_HEIGHTS = 8
+
+
+class Step(enum.IntEnum):
+    """
+    The step of the round a node is in.  Steps only move forwards within a
+    round, so they're ordered
+    """
+
+    PROPOSE = 0
+    PREVOTE = 1
+    PRECOMMIT = 2
+
+
+# step -> the timeout message scheduled for that step
+TIMEOUT_TYPES = {
+    Step.PROPOSE: ProposalTimeout,
+    Step.PREVOTE: PrevoteTimeout,
+    Step.PRECOMMIT: PrecommitTimeout,
+}
 
 
 def get_value():
@@ -18,10 +66,120 @@ def get_value():
     using an external function getValue() that returns a valid value to propose."
     """
     # Our "blocks" will be random strings of 4 characters
-    return "".join(random.choice(string.ascii_letters) for _ in range(4))
+    return "".join(random.choices(string.ascii_letters, k=4))
+
+
+@functools.lru_cache(maxsize=1024)
+def value_id(v):
+    """
+    See TendermintNode.id_.  Every node asks for the ids of the same few values
+    (and the proposer and colluding nodes ask more than once), so cache them
+    across nodes rather than re-encoding each time
+    """
+    return int.from_bytes(v.encode("ascii"), "little")
+
+
+def round_key(h, round):
+    """
+    Packs (h, round) into a single int to key our per-round state.  Unlike a
+    tuple, this needs no allocation and hashes to itself
+    """
+    return (h << 32) | round
+
+
+def wire_all(nodes):
+    """
+    Makes every node in nodes (node_id -> node) a peer of all the others
+    """
+    for i, node in nodes.items():
+        node.set_peers(tuple(j for j in nodes if j != i))
+
+
+class VoteSet:
+    """
+    The votes cast in a single referendum, i.e. the prevotes or precommits for
+    one (h, round).
+
+    Besides remembering each sender's vote, we keep a running count per id(v)
+    so a QC is detected the moment a vote pushes some value over the
+    threshold, instead of re-counting every vote on each arrival.
+
+    node_ids are always 0 to num_nodes-1, so votes are stored in flat lists
+    indexed by sender rather than in a dict per round.
+    """
+
+    # Every vote touches these, so skip the per-instance __dict__
+    __slots__ = (
+        "threshold",
+        "ids",
+        "num_votes",
+        "counts",
+        "have_qc",
+        "qc_idv",
+    )
+
+    def __init__(self, threshold, num_nodes):
+        self.threshold = threshold
+        # node_id -> id(v).  A NIL vote is None, so slots we haven't had a vote
+        # for yet hold NO_VOTE instead
+        self.ids = [NO_VOTE] * num_nodes
+        self.num_votes = 0
+        # id(v) -> number of votes for it
+        self.counts = {}
+        # A QC can be on NIL, so we can't use qc_idv alone to tell if we have one
+        self.have_qc = False
+        self.qc_idv = None
+
+    def __len__(self):
+        return self.num_votes
+
+    def __contains__(self, sender):
+        return self.ids[sender] is not NO_VOTE
+
+    def add(self, sender, id_v):
+        self.ids[sender] = id_v
+        self.num_votes += 1
+        count = self.counts.get(id_v, 0) + 1
+        self.counts[id_v] = count
+        # Can only ever have one QC, so the first value to reach it is the QC
+        if not self.have_qc and count >= self.threshold:
+            self.have_qc = True
+            self.qc_idv = id_v
 
 
 class TendermintNode:
+    # Every message handler reads and writes these, so as with VoteSet, skip
+    # the per-instance __dict__.  Subclasses adding their own attributes
+    # need their own __slots__ to keep the saving
+    __slots__ = (
+        "h",
+        "round",
+        "step",
+        "decision",
+        "locked_value",
+        "locked_round",
+        "valid_value",
+        "valid_round",
+        "node_id",
+        "num_nodes",
+        "round_time_ns",
+        "start_time",
+        "f",
+        "quorum",
+        "message_queue",
+        "scheduler",
+        "proposals",
+        "prevotes",
+        "precommits",
+        "peers",
+        "verbose",
+        "_scheduled_timeouts",
+        "_handlers",
+        "_batch",
+        "_inbox",
+        "_dispatching",
+    )
+
     def __init__(
         self, node_id, num_nodes, round_time, message_queue, scheduler, verbose=False
     ):
@@ -30,8 +188,8 @@ class TendermintNode:
         self.h = 0
         # current round number
         self.round = 0
-        # {propose, prevote, precommit}
-        self.step = "propose"
+        # Step.PROPOSE, PREVOTE or PRECOMMIT
+        self.step = Step.PROPOSE
         # our blockchain, a mapping from h to block (or 'value' in the paper terminology)
         self.decision = {}
         # value = block
@@ -43,26 +201,55 @@ class TendermintNode:
         ### Below this point are variables not from the pseudocode
         self.node_id = node_id
         self.num_nodes = num_nodes
-        self.round_time = round_time
-        self.start_time = time.time()
+        # round_time is in seconds, but the scheduler's clock counts integer ns
+        self.round_time_ns = round(round_time * 1_000_000_000)
+        # Timeouts are scheduled relative to this, on the scheduler's clock
+        self.start_time = scheduler.now()
         # "for simplicity we present the algorithm for the case n = 3f + 1"
-        self.f = (num_nodes - 1) / 3
-        assert self.f == int(self.f), "(num_nodes-1) must be divisble by 3!"
+        self.f = (num_nodes - 1) // 3
+        assert 3 * self.f + 1 == num_nodes, "(num_nodes-1) must be divisble by 3!"
+        # Number of votes needed for a QC, compared against on every vote
+        self.quorum = 2 * self.f + 1
         self.message_queue = message_queue
         self.scheduler = scheduler
 
         # Paper description involves storing all messages sent and received in a
         # message log.  Instead we'll store information we need in these dicts
-        # (h, round) -> {"proposal": ..., "valid_round": ...}
+        # round_key(h, round) -> {"proposal": ..., "valid_round": ..., "id": ...}
         self.proposals = {}
-        # (h, round) -> node_id -> id(v) (aka block_hash)
-        self.prevotes = defaultdict(dict)
-        self.precommits = defaultdict(dict)
-
-        # node_ids of other nodes, we'll use this for broadcasting
-        self.peers = []
+        # round_key(h, round) -> VoteSet of node_id -> id(v) (aka block_hash)
+        # Both are filled in by start_round, or on the first vote if a round's
+        # votes arrive before we start it
+        self.prevotes = {}
+        self.precommits = {}
+
+        # node_ids of other nodes, we'll use this for broadcasting.  A tuple, so
+        # the queue can hold on to it as a broadcast's recipients without a copy
+        self.peers = ()
         self.verbose = verbose
 
+        # (step, h, round) of timeouts already in the scheduler, so we never
+        # push the same timeout twice
+        self._scheduled_timeouts = set()
+
+        # message type -> handler, built once rather than on every message
+        self._handlers = {
+            Proposal: self.handle_proposal,
+            Prevote: self.handle_prevote,
+            Precommit: self.handle_precommit,
+            ProposalTimeout: self.on_timeout_proposal,
+            PrevoteTimeout: self.on_timeout_prevote,
+            PrecommitTimeout: self.on_timeout_precommit,
+            Batch: self.handle_batch,
+        }
+        # While not None, broadcasts are collected here instead of being sent,
+        # see start_batch
+        self._batch = None
+        # Messages waiting to be handled, and whether we're already handling
+        # one, see process_message
+        self._inbox = collections.deque()
+        self._dispatching = False
+
     def print_blocks(self):
         blocks = [self.decision.get(i) for i in range(self.h) if self.decision.get(i)]
         print(f"{self.node_id} BLOCKS: {blocks}")
@@ -71,8 +258,13 @@ class TendermintNode:
         """
         peer_id is an int from 0 to num_nodes-1
         """
-        assert isinstance(peer_id, int)
-        self.peers.append(peer_id)
+        self.set_peers(self.peers + (peer_id,))
+
+    def set_peers(self, peer_ids):
+        """
+        Replaces all our peers at once, see add_peer
+        """
+        self.peers = tuple(peer_ids)
 
     def broadcast(self, msg):
         """
@@ -80,29 +272,75 @@ class TendermintNode:
         """
         if self.verbose:
             print(self.node_id, "broadcasting:", msg)
-        for to_node_id in self.peers:
-            # copying messages so we can pop the msg_type
-            self.message_queue.send_message(to_node_id, dict(msg))
+        if self._batch is not None:
+            self._batch.append(msg)
+        else:
+            # The same (frozen) msg goes to every peer, so the queue only needs
+            # to store it once
+            self.message_queue.send_many(self.peers, msg)
         # Algorithm also calls for storing our own messages in the message log
-        # We can accomplish this by processing our own message
+        # We can accomplish this by processing our own message.  If we're in
+        # the middle of handling a message it waits until that one is done
         self.process_message(msg)
 
+    def start_batch(self):
+        """
+        Starts collecting our broadcasts so they can go out together in
+        send_batch.  We still process our own messages immediately.  Returns
+        False if a batch was already in progress, in which case the caller's
+        messages just join it and the caller shouldn't send it
+        """
+        if self._batch is not None:
+            return False
+        self._batch = []
+        return True
+
+    def send_batch(self):
+        """
+        Sends the collected broadcasts, with each run of messages for the same
+        (h, round) going to peers as one Batch
+        """
+        msgs, self._batch = self._batch, None
+        for _, group in itertools.groupby(msgs, key=lambda m: (m.h, m.round)):
+            group = tuple(group)
+            if len(group) == 1:
+                self.message_queue.send_many(self.peers, group[0])
+            else:
+                batch = Batch(h=group[0].h, round=group[0].round, msgs=group)
+                self.message_queue.send_many(self.peers, batch)
+
     def schedule(self, msg, scheduled_time):
         self.scheduler.schedule_message(self.node_id, msg, scheduled_time)
 
     def process_message(self, msg):
         if self.verbose:
             print(self.node_id, "received:", msg)
-        handler_map = {
-            "PROPOSAL": self.handle_proposal,
-            "PREVOTE": self.handle_prevote,
-            "PRECOMMIT": self.handle_precommit,
-            "PROPOSAL_TIMEOUT": self.on_timeout_proposal,
-            "PREVOTE_TIMEOUT": self.on_timeout_prevote,
-            "PRECOMMIT_TIMEOUT": self.on_timeout_precommit,
-        }
-        msg_type = msg.pop("msg_type")
-        handler_map[msg_type](**msg)
+        # We've pruned everything for heights this old, see _prune_heights
+        if msg.h < self.h - KEEP_HEIGHTS:
+            return
+        self._inbox.append(msg)
+        if self._dispatching:
+            return
+        # Handling a message can make us broadcast, which means handling our
+        # own message, which can make us broadcast again...  Rather than
+        # recursing, messages that come up while we're busy are queued in
+        # _inbox and handled here in order, once the current one is done.
+        # Everything we broadcast meanwhile goes out as batches at the end
+        self._dispatching = True
+        sending_batch = self.start_batch()
+        try:
+            while self._inbox:
+                msg = self._inbox.popleft()
+                self._handlers[type(msg)](msg)
+        finally:
+            # If a handler raised, drop whatever is still waiting so the error
+            # propagates and we can carry on handling later messages.  What we
+            # broadcast before the error still goes out, as it would have had
+            # we not been batching
+            self._inbox.clear()
+            self._dispatching = False
+            if sending_batch:
+                self.send_batch()
 
     def proposer(self, h, round):
         """
@@ -119,9 +357,10 @@ class TendermintNode:
     def valid(self, v):
         """
         Returns whether or not a block is valid.  'get_value' returns a 4
-        character string, so we'll treat any 4 character string as valid
+        character ASCII string, so we'll treat any 4 character ASCII string as
+        valid
         """
-        return isinstance(v, str) and len(v) == 4
+        return isinstance(v, str) and len(v) == 4 and v.isascii()
 
     def id_(self, v):
         """
@@ -132,78 +371,50 @@ class TendermintNode:
         constant size value id (a unique value identifier, normally a hash of the
         value)... The PROPOSAL message is the only one carrying the value; PREVOTE
         and PRECOMMIT messages carry the value id."
-        """
-        return zlib.crc32(v.encode())
 
-    def _tally_votes(self, votes_dict):
-        """
-        Input is a dictionary of votes for a given round,
-        key is the node_id, value is their vote in id_(v) format
+        Our values are always 4 ASCII characters, so rather than hashing them we
+        pack the 4 bytes directly into a 32 bit int, which is unique per value
+        by construction
         """
-        votes = Counter(votes_dict.values())
-        qc = [x for x in votes if votes[x] >= (2 * self.f + 1)]
-        if qc:
-            # Can only ever have one QC, so return [0]
-            return True, qc[0]
-        return False, None
+        return value_id(v)
 
+    # Each broadcast_* builds its message positionally, skipping keyword
+    # matching.  They stay as methods so byzantine nodes can override them
     def broadcast_proposal(self, h, round, proposal, valid_round):
-        msg = {
-            "msg_type": "PROPOSAL",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "proposal": proposal,
-            "valid_round": valid_round,
-        }
-        self.broadcast(msg)
+        self.broadcast(Proposal(self.node_id, h, round, proposal, valid_round))
 
     def broadcast_prevote(self, h, round, id_v):
-        msg = {
-            "msg_type": "PREVOTE",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "id_v": id_v,
-        }
-        self.broadcast(msg)
+        self.broadcast(Prevote(self.node_id, h, round, id_v))
 
     def broadcast_precommit(self, h, round, id_v):
-        msg = {
-            "msg_type": "PRECOMMIT",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "id_v": id_v,
-        }
-        self.broadcast(msg)
-
-    def schedule_ontimeout_proposal(self, h, round):
-        msg = {
-            "msg_type": "PROPOSAL_TIMEOUT",
-            "height": h,
-            "round": round,
-        }
-        timeout_time = self.start_time + (round + 1) * self.round_time
-        self.schedule(msg, timeout_time)
+        self.broadcast(Precommit(self.node_id, h, round, id_v))
 
-    def schedule_ontimeout_prevote(self, h, round):
-        msg = {
-            "msg_type": "PREVOTE_TIMEOUT",
-            "height": h,
-            "round": round,
-        }
-        timeout_time = self.start_time + (round + 1) * self.round_time
+    def schedule_timeout(self, step, h, round):
+        """
+        Schedules the timeout for the given step of a round.  Every step's
+        timeout fires at the end of the round, so they only differ in type
+        """
+        timeout = (step, h, round)
+        if timeout in self._scheduled_timeouts:
+            return
+        self._scheduled_timeouts.add(timeout)
+        msg = TIMEOUT_TYPES[step](h=h, round=round)
+        timeout_time = self.start_time + (round + 1) * self.round_time_ns
         self.schedule(msg, timeout_time)
 
-    def schedule_ontimeout_precommit(self, h, round):
-        msg = {
-            "msg_type": "PRECOMMIT_TIMEOUT",
-            "height": h,
-            "round": round,
-        }
-        timeout_time = self.start_time + (round + 1) * self.round_time
-        self.schedule(msg, timeout_time)
+    def _prune_heights(self):
+        """
+        Drops proposals and votes for heights more than KEEP_HEIGHTS below
+        our current one, so memory stays bounded over a long run.  We keep
+        'decision' in full as it's our blockchain
+        """
+        if self.h <= KEEP_HEIGHTS:
+            return
+        # round_key orders by height first, so all older keys are below this
+        cutoff = round_key(self.h - KEEP_HEIGHTS, 0)
+        for store in (self.proposals, self.prevotes, self.precommits):
+            for key in [key for key in store if key < cutoff]:
+                del store[key]
 
     def start_round(self, round):
         """
@@ -212,7 +423,18 @@ class TendermintNode:
         if self.verbose:
             print(f"\n{self.node_id} --- STARTING ROUND {round}")
         self.round = round
-        self.step = "propose"
+        self.step = Step.PROPOSE
+        # Timeouts for earlier rounds will be ignored when they fire, and
+        # rounds only move forwards, so we can stop tracking them
+        self._scheduled_timeouts = {
+            t for t in self._scheduled_timeouts if t[2] >= round
+        }
+
+        key = round_key(self.h, round)
+        if key not in self.prevotes:
+            self.prevotes[key] = VoteSet(self.quorum, self.num_nodes)
+        if key not in self.precommits:
+            self.precommits[key] = VoteSet(self.quorum, self.num_nodes)
 
         if self.proposer(self.h, self.round) == self.node_id:
             # If in the previous round we saw a prevote QC, but NOT a precommit QC,
@@ -226,21 +448,41 @@ class TendermintNode:
             # In addition to the value proposed, the PROPOSAL message also contains
             # the validRound so other processes are informed about the last round
             # in which the proposer observed validValue as a possible decision value.
-            self.broadcast_proposal(self.h, round, proposal, self.valid_round)
+            # Processing our own proposal makes us prevote straight away, so
+            # peers get the PROPOSAL and our PREVOTE as a single batch
+            sending_batch = self.start_batch()
+            try:
+                self.broadcast_proposal(self.h, round, proposal, self.valid_round)
+            finally:
+                if sending_batch:
+                    self.send_batch()
             # Note that when we broadcast_proposal, it will call a function
             # to prevote for this value
-            self.step = "prevote"
+            self.step = Step.PREVOTE
         else:
-            self.schedule_ontimeout_proposal(self.h, self.round)
+            self.schedule_timeout(Step.PROPOSE, self.h, self.round)
+
+    def handle_batch(self, msg):
+        for m in msg.msgs:
+            self.process_message(m)
 
-    def handle_proposal(self, sender, h, round, proposal, valid_round):
+    def handle_proposal(self, msg):
         ## lines 22-27
+        sender, h, round = msg.sender, msg.h, msg.round
+        proposal, valid_round = msg.proposal, msg.valid_round
+        key = round_key(h, round)
         assert sender == self.proposer(h, round)
         assert (
-            h,
-            round,
-        ) not in self.proposals, f"Shouldn't receive multiple proposals! Round {round}, TO {self.node_id} FROM {sender}"
-        self.proposals[(h, round)] = {"proposal": proposal, "valid_round": valid_round}
+            key not in self.proposals
+        ), f"Shouldn't receive multiple proposals! Round {round}, TO {self.node_id} FROM {sender}"
+        # Every vote for this round gets compared against id(proposal), so
+        # compute it once here rather than on each vote
+        proposal_id = self.id_(proposal) if self.valid(proposal) else NIL
+        entry = self.proposals[key] = {
+            "proposal": proposal,
+            "valid_round": valid_round,
+            "id": proposal_id,
+        }
         # Think there's a pseudocode error on line 22
         # upon <PROPOSAL, h_p, round_p , v, −1>
         # The last value should be *, not -1
@@ -250,101 +492,160 @@ class TendermintNode:
             if self.valid(proposal) and (
                 self.locked_round == -1 or self.locked_value == proposal
             ):
-                self.broadcast_prevote(h, round, self.id_(proposal))
+                self.broadcast_prevote(h, round, proposal_id)
             else:
                 self.broadcast_prevote(h, round, NIL)
-            self.step = "prevote"
+            self.step = Step.PREVOTE
+
+        # Votes can beat the proposal to us, and any QC they formed had no
+        # value to match yet.  Now that we have it, act on those QCs - lines
+        # 36-43 are only for our current round, line 49 is for any round
+        prevotes = self.prevotes.get(key)
+        if prevotes is not None and self.round == round:
+            self._upon_prevote_qc(h, round, prevotes, entry)
+        precommits = self.precommits.get(key)
+        if precommits is not None:
+            self._upon_precommit_qc(h, round, precommits, entry)
+
+    def _upon_prevote_qc(self, h, round, votes, entry):
+        """
+        ## lines 36-43
 
-    def handle_prevote(self, sender, h, round, id_v):
-        ## lines 34-35
-        # Honest nodes should vote at most once in any referendum
-        assert (
-            sender not in self.prevotes[(h, round)]
-        ), f"Shouldn't receive multiple prevotes! Round {round}, TO {self.node_id} FROM {sender}"
+        Called whenever we might have both a prevote QC for (h, round) and the
+        round's proposal, i.e. when either a prevote or the proposal arrives.
+        Unlike a precommit QC, this only counts for our current round
+        """
+        if not votes.have_qc or entry is None:
+            return
+        if round != self.round:
+            return
+        proposal = entry["proposal"]
+        if self.step >= Step.PREVOTE:
+            if self.valid(proposal) and votes.qc_idv == entry["id"]:
+                if self.step == Step.PREVOTE:
+                    self.locked_value = proposal
+                    self.locked_round = round
+                    self.broadcast_precommit(h, round, votes.qc_idv)
+                    self.step = Step.PRECOMMIT
+                self.valid_value = proposal
+                self.valid_round = round
+
+    def _upon_precommit_qc(self, h, round, votes, entry):
+        """
+        ## lines 49-54
+
+        As with _upon_prevote_qc, called when either a precommit or the proposal
+        arrives.  A precommit QC decides the block whatever round we're in now
+        """
+        if not votes.have_qc or entry is None or self.decision.get(h, NIL) != NIL:
+            return
+        proposal = entry["proposal"]
+        # Make sure it matches what we have for our proposal
+        if self.valid(proposal) and votes.qc_idv == entry["id"]:
+            if self.verbose:
+                print(
+                    f"BUILT PRECOMMIT QC FOR BLOCK {proposal} AT HEIGHT {h} IN ROUND {round} "
+                )
+                self.print_blocks()
+
+            self.decision[h] = proposal
+            self.h += 1
+            self._prune_heights()
+            self.locked_round = -1
+            self.locked_value = NIL
+            self.valid_round = -1
+            self.valid_value = NIL
+            self.start_round(round + 1)
 
-        self.prevotes[(h, round)][sender] = id_v
-        num_prevotes = len(self.prevotes[(h, round)])
-        have_qc, qc_idv = self._tally_votes(self.prevotes[(h, round)])
+    def handle_prevote(self, msg):
+        ## lines 34-35
+        sender, h, round, id_v = msg.sender, msg.h, msg.round, msg.id_v
+        key = round_key(h, round)
+        votes = self.prevotes.get(key)
+        if votes is None:
+            votes = self.prevotes[key] = VoteSet(self.quorum, self.num_nodes)
+        # Honest nodes vote at most once in any referendum, so a repeat can
+        # only come from a byzantine node - count their first vote only
+        if sender in votes:
+            return
+
+        votes.add(sender, id_v)
+        num_prevotes = len(votes)
+        # The VoteSet spots the QC as votes arrive, so there's nothing to tally
+        have_qc, qc_idv = votes.have_qc, votes.qc_idv
+
+        # Votes can arrive before the proposal does, in which case there's
+        # nothing for a QC to match yet
+        entry = self.proposals.get(key)
+        if entry is not None:
+            proposal, proposal_id = entry["proposal"], entry["id"]
+        else:
+            proposal = proposal_id = NIL
 
         ## lines 28-33
-        if have_qc and self.step == "propose":
-            valid_round = self.proposals[(h, round)]["valid_round"]
-            proposal = self.proposals[(h, round)]["proposal"]
+        if have_qc and self.step == Step.PROPOSE and entry is not None:
+            valid_round = entry["valid_round"]
             # 'valid_round' will be the round in which they locked this value
             if valid_round >= 0 and valid_round < self.round:
                 if self.valid(proposal) and (
                     self.locked_round <= valid_round or self.locked_value == proposal
                 ):
-                    self.broadcast_prevote(h, round, self.id_(proposal))
+                    self.broadcast_prevote(h, round, proposal_id)
                 else:
                     self.broadcast_prevote(h, round, NIL)
-                self.step = "prevote"
+                self.step = Step.PREVOTE
 
         ## lines 34-35
-        if self.step == "prevote":
+        if self.step == Step.PREVOTE:
             # Upon 2f+1
             # By checking for exact count we'll only do it once!
-            if num_prevotes == (2 * self.f + 1):
+            if num_prevotes == self.quorum:
                 # TODO - not clear if this should be self.h
-                self.schedule_ontimeout_prevote(h, round)
+                self.schedule_timeout(Step.PREVOTE, h, round)
 
         ## lines 36-43
-        if have_qc and self.step in {"prevote", "precommit"}:
-            proposal = self.proposals[(h, round)]["proposal"]
-            if self.valid(proposal) and qc_idv == self.id_(proposal):
-                if self.step == "prevote":
-                    self.locked_value = proposal
-                    self.locked_round = round
-                    self.broadcast_precommit(h, round, qc_idv)
-                    self.step = "precommit"
-                self.valid_value = proposal
-                self.valid_round = round
+        self._upon_prevote_qc(h, round, votes, entry)
 
         ## lines 44-46
-        if self.step == "prevote" and have_qc and qc_idv == NIL:
+        if self.step == Step.PREVOTE and have_qc and qc_idv == NIL:
             self.broadcast_precommit(h, round, NIL)
-            self.step = "precommit"
+            self.step = Step.PRECOMMIT
 
         ##  lines 55-59
         # If we start getting votes for future round, we need to start it!
-        if num_prevotes == (2 * self.f + 1) and round > self.round:
+        if num_prevotes == self.quorum and round > self.round:
             self.start_round(round)
 
-    def handle_precommit(self, sender, h, round, id_v):
+    def handle_precommit(self, msg):
         """
         ## lines 49-55
         """
-        # Honest nodes should vote at most once in any referendum
-        assert (
-            sender not in self.precommits[(h, round)]
-        ), f"Shouldn't receive multiple prevotes! Round {round}, TO {self.node_id} FROM {sender}"
-        self.precommits[(h, round)][sender] = id_v
-        num_precommits = len(self.precommits[(h, round)])
-        have_qc, qc_idv = self._tally_votes(self.precommits[(h, round)])
+        sender, h, round, id_v = msg.sender, msg.h, msg.round, msg.id_v
+        key = round_key(h, round)
+        votes = self.precommits.get(key)
+        if votes is None:
+            votes = self.precommits[key] = VoteSet(self.quorum, self.num_nodes)
+        # Honest nodes vote at most once in any referendum, so a repeat can
+        # only come from a byzantine node - count their first vote only
+        if sender in votes:
+            return
+        votes.add(sender, id_v)
+        num_precommits = len(votes)
+        have_qc, qc_idv = votes.have_qc, votes.qc_idv
 
         # Upon 2f+1 votes
         # Only do it once!
-        if num_precommits == (2 * self.f + 1):
-            # self.schedule_ontimeout_precommit(self.h, round)
-            self.schedule_ontimeout_precommit(self.h, round)
+        if num_precommits == self.quorum:
+            self.schedule_timeout(Step.PRECOMMIT, self.h, round)
 
-        proposal = self.proposals[(h, round)]["proposal"]
-        if have_qc and self.decision.get(h, NIL) == NIL:
-            # Make sure it matches what we have for our proposal
-            if self.valid(proposal) and qc_idv == self.id_(proposal):
-                if self.verbose:
-                    print(
-                        f"BUILT PRECOMMIT QC FOR BLOCK {proposal} AT HEIGHT {h} IN ROUND {round} "
-                    )
-                    self.print_blocks()
-
-                self.decision[h] = proposal
-                self.h += 1
-                self.locked_round = -1
-                self.locked_value = NIL
-                self.valid_round = -1
-                self.valid_value = NIL
-                self.start_round(round + 1)
+        # As with prevotes, we might not have the proposal yet
+        entry = self.proposals.get(key)
+        if entry is not None:
+            proposal, proposal_id = entry["proposal"], entry["id"]
+        else:
+            proposal = proposal_id = NIL
+
+        self._upon_precommit_qc(h, round, votes, entry)
 
         # This is not in pseudocode but necessary to handle scenarios where a
         # subset of nodes see a precommit QC.
@@ -356,9 +657,14 @@ class TendermintNode:
         # in a new round we handle this scenario.
         # An alternative approach would be to broadcast full QCs if a node sees
         # a block being proposed that they already have a QC for.
-        if round == self.round and have_qc and self.decision.get(h, NIL) == proposal:
+        if (
+            round == self.round
+            and have_qc
+            and entry is not None
+            and self.decision.get(h, NIL) == proposal
+        ):
             # Make sure it matches what we have for our proposal
-            assert self.valid(proposal) and qc_idv == self.id_(proposal)
+            assert self.valid(proposal) and qc_idv == proposal_id
             if self.verbose:
                 self.print_blocks()
 
@@ -373,10 +679,10 @@ class TendermintNode:
 
         ##  lines 55-59
         # If we start getting votes for future round, we need to start it!
-        if num_precommits == (2 * self.f + 1) and round > self.round:
+        if num_precommits == self.quorum and round > self.round:
             self.start_round(round)
 
-    def on_timeout_proposal(self, height, round):
+    def on_timeout_proposal(self, msg):
         """
         ## lines 57-60
 
@@ -389,21 +695,24 @@ class TendermintNode:
         If things are going well, this condition will NOT be met, and we won't
         broadcast a nil prevote here
         """
-        if height == self.h and round == self.round and self.step == "propose":
+        height, round = msg.h, msg.round
+        if height == self.h and round == self.round and self.step == Step.PROPOSE:
             self.broadcast_prevote(height, round, NIL)
-            self.step = "prevote"
+            self.step = Step.PREVOTE
 
-    def on_timeout_prevote(self, height, round):
+    def on_timeout_prevote(self, msg):
         """
         ## lines 61-64
         """
-        if height == self.h and round == self.round and self.step == "prevote":
+        height, round = msg.h, msg.round
+        if height == self.h and round == self.round and self.step == Step.PREVOTE:
             self.broadcast_precommit(height, round, NIL)
-            self.step = "precommit"
+            self.step = Step.PRECOMMIT
 
-    def on_timeout_precommit(self, height, round):
+    def on_timeout_precommit(self, msg):
         """
         ## lines 65-67
         """
+        height, round = msg.h, msg.round
         if height == self.h and round == self.round:
             self.start_round(round + 1)
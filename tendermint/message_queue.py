@@ -1,60 +1,110 @@
 import time
-from queue import PriorityQueue
+import heapq
 
 
 class MessageQueue:
+    __slots__ = (
+        "nodes",
+        "q",
+        "message_i",
+        "block_height",
+        "round",
+        "committed",
+        "checked_heights",
+        "start_time",
+        "round_time_ns",
+    )
+
     def __init__(self, nodes, round_time):
         self.nodes = nodes
-        self.q = PriorityQueue()
-        self.message_dict = {}
+        # heap of (scheduled_time, message_i, node_ids, message).  A broadcast
+        # is a single entry for all of its recipients.  message_i counts up with
+        # every entry, so messages due at the same time are delivered in the
+        # order they were sent, and the messages themselves never get compared.
+        # The simulator is single threaded, so a plain heapq list does the job
+        # without the locking that queue.PriorityQueue does on every put and get
+        self.q = []
         self.message_i = 0
 
         ## Storing a view of chain state for our liveness checks
         self.block_height = 0
         self.round = 0
+        ## And for our safety checks - height -> the first value we saw decided
+        # for it, and node_id -> the heights we've already checked for that node
+        self.committed = {}
+        self.checked_heights = {}
         ## Store round_time so we can schedule messages in a way that makes
-        # for pretty printing
-        self.start_time = time.time()
-        self.round_time = round_time
+        # for pretty printing.  round_time is in seconds, our clock counts ns
+        self.start_time = self.now()
+        self.round_time_ns = round(round_time * 1_000_000_000)
+
+    def now(self):
+        """
+        Current time on the clock that scheduled times are measured against, in
+        integer nanoseconds.  Nodes use this too, as we're also their scheduler.
+        Ints keep the heap's time comparisons exact and cheap, and a monotonic
+        clock can't jump backwards under us
+        """
+        return time.monotonic_ns()
 
     def run(self):
         count = 0
+        # Looked up once here rather than on every message
+        q = self.q
+        heappop = heapq.heappop
+        process_message = self.process_message
         while True:
-            assert not self.q.empty(), "Empty queue!  Program stuck"
-            (ts, node_id, message_i) = self.q.get()
+            assert q, "Empty queue!  Program stuck"
             # Might be a scheduled message - need to wait for those
-            now = time.time()
-            if now < ts:
-                time.sleep(ts - now)
-            message = self.message_dict.pop(message_i)
-            self.process_message(node_id, message)
-            count += 1
-            if count % 100 == 0:
-                self.safety_check()
-                self.liveness_check()
+            wait = q[0][0] - self.now()
+            if wait > 0:
+                time.sleep(wait / 1_000_000_000)
+            # Then process everything that's already due in one go, rather than
+            # going back to the clock after every message
+            now = self.now()
+            while q and q[0][0] <= now:
+                (ts, message_i, node_ids, message) = heappop(q)
+                for node_id in node_ids:
+                    process_message(node_id, message)
+                    count += 1
+                    if count % 100 == 0:
+                        self.safety_check()
+                        self.liveness_check()
 
-    def send_message(self, node_id, message):
+    def push(self, scheduled_time, node_ids, message):
         """
-        Just adds it to queue
+        Adds an entry delivering message to each of node_ids at scheduled_time
         """
-        self.message_dict[self.message_i] = message
+        heapq.heappush(self.q, (scheduled_time, self.message_i, node_ids, message))
+        self.message_i += 1
+
+    def send_time(self, message):
         # This logic prevents it from racing ahead to the next block once a block
         # is built, not sure this is what happens in real tendermint but it's
         # helpful for pretty printing output
-        scheduled_time = max(
-            time.time(), self.start_time + (message["round"]) * self.round_time
-        )
-        self.q.put((scheduled_time, node_id, self.message_i))
-        self.message_i += 1
+        return max(self.now(), self.start_time + message.round * self.round_time_ns)
+
+    def send_message(self, node_id, message):
+        """
+        Just adds it to queue
+        """
+        self.push(self.send_time(message), (node_id,), message)
+
+    def send_many(self, node_ids, message):
+        """
+        Sends the same message to every node in node_ids as a single queue
+        entry, delivered to them in order when it's popped
+        """
+        if not node_ids:
+            return
+        self.push(self.send_time(message), tuple(node_ids), message)
 
     def schedule_message(self, node_id, message, scheduled_time):
         """
         We're using single module for both message queue and scheduler
         This method should be implemented on any other scheduler
         """
-        self.message_dict[self.message_i] = message
-        self.q.put((scheduled_time, node_id, self.message_i))
-        self.message_i += 1
+        self.push(scheduled_time, (node_id,), message)
 
     def process_message(self, node_id, message):
         self.nodes[node_id].process_message(message)
@@ -62,31 +112,32 @@ class MessageQueue:
     def safety_check(self):
         """
         Make sure no nodes have different values (blocks) for any block height
+
+        Decisions are never changed once made, so we only look at the heights
+        each node has decided since the last check, and compare them against
+        the first value we saw decided for that height
         """
-        # Every node should generally be on the same round, and 'round' upper
-        # bounds height
-        round = self.nodes[0].round
-        for i in range(0, round):
-            # It's ok if some blocks have fallen behind and have NIL/None
-            decisions = {
-                self.nodes[x].decision.get(i, None)
-                for x in self.nodes
-                if self.nodes[x].decision.get(i, None)
-            }
-            if len(decisions) > 1:
-                dec_all = list(decisions)
-                print("\n####### SAFETY VIOLATION!!! #######")
-                # First print all blocks, then print specific information about violation
-                for x in self.nodes:
-                    self.nodes[x].print_blocks()
-                for dec in dec_all:
-                    matches = {
-                        self.nodes[i].node_id
-                        for i in self.nodes
-                        if self.nodes[i].decision.get(i, None) == dec
-                    }
-                    print(f"NODES {matches} BLOCK HEIGHT {i} VALUE {dec}")
-                raise Exception("Safety Violation!")
+        for node_id, node in self.nodes.items():
+            for i in range(self.checked_heights.get(node_id, 0), node.h):
+                # It's ok if some blocks have fallen behind and have NIL/None
+                dec = node.decision.get(i, None)
+                if dec is None:
+                    continue
+                committed = self.committed.setdefault(i, dec)
+                if dec != committed:
+                    print("\n####### SAFETY VIOLATION!!! #######")
+                    # First print all blocks, then print specific information about violation
+                    for x in self.nodes:
+                        self.nodes[x].print_blocks()
+                    for value in (committed, dec):
+                        matches = {
+                            self.nodes[x].node_id
+                            for x in self.nodes
+                            if self.nodes[x].decision.get(i, None) == value
+                        }
+                        print(f"NODES {matches} BLOCK HEIGHT {i} VALUE {value}")
+                    raise Exception("Safety Violation!")
+            self.checked_heights[node_id] = node.h
 
     def liveness_check(self):
         """
@@ -94,8 +145,11 @@ class MessageQueue:
         we'll call it a liveness violation (even though in reality I think
         it's more subtle than this)
         """
-        block_height = max([len(self.nodes[x].decision) for x in self.nodes])
-        round = max([self.nodes[x].round for x in self.nodes])
+        # One pass over the nodes for both maxes
+        block_height = round = 0
+        for node in self.nodes.values():
+            block_height = max(block_height, len(node.decision))
+            round = max(round, node.round)
 
         new_blocks = block_height - self.block_height
         rounds_passed = round - self.round
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+from typing import Optional
+
+"""
+The messages nodes send each other, and the timeouts they schedule for
+themselves.  Nodes dispatch on the type of the message.
+
+All of them are frozen, so a single instance can be shared by every peer we
+broadcast to, and slotted, so they're much smaller than the equivalent dict.
+"""
+
+
+@dataclass(slots=True, frozen=True)
+class Proposal:
+    """
+    The only message carrying a value (block), see id_ in algorithm.py
+    """
+
+    sender: int
+    h: int
+    round: int
+    proposal: Optional[str]
+    valid_round: int
+
+
+@dataclass(slots=True, frozen=True)
+class Prevote:
+    sender: int
+    h: int
+    round: int
+    # id(v) of the value being voted for, or NIL
+    id_v: Optional[int]
+
+
+@dataclass(slots=True, frozen=True)
+class Precommit:
+    sender: int
+    h: int
+    round: int
+    # id(v) of the value being voted for, or NIL
+    id_v: Optional[int]
+
+
+@dataclass(slots=True, frozen=True)
+class ProposalTimeout:
+    h: int
+    round: int
+
+
+@dataclass(slots=True, frozen=True)
+class PrevoteTimeout:
+    h: int
+    round: int
+
+
+@dataclass(slots=True, frozen=True)
+class PrecommitTimeout:
+    h: int
+    round: int
+
+
+@dataclass(slots=True, frozen=True)
+class Batch:
+    """
+    Several consecutive messages from one sender for the same (h, round), sent
+    as a single queue entry.  Receivers process msgs in order
+    """
+
+    h: int
+    round: int
+    msgs: tuple
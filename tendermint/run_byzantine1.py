@@ -1,5 +1,6 @@
 import algorithm
 import message_queue
+import messages
 
 """
 SAFETY FAILURE EXAMPLE
@@ -16,7 +17,7 @@ class CollusionTracker:
 
     def __init__(self, byzantine_nodes):
         self._votes = {}
-        self.byzantine_nodes = byzantine_nodes
+        self.byzantine_nodes = frozenset(byzantine_nodes)
 
     def store_vote(self, node_id, round, id_v):
         """
@@ -52,6 +53,17 @@ class TendermintNodeByzantineCollude(algorithm.TendermintNode):
     ):
         super().__init__(node_id, num_nodes, round_time, mq, scheduler, verbose)
         self.collusion_tracker = collusion_tracker
+        # Our honest peers, and the half of them we'll send the alternate
+        # proposal to.  These only change when peers are added
+        self._honest_peers = ()
+        self._send_alt = ()
+
+    def set_peers(self, peer_ids):
+        super().set_peers(peer_ids)
+        self._honest_peers = tuple(
+            x for x in self.peers if x not in self.collusion_tracker.byzantine_nodes
+        )
+        self._send_alt = self._honest_peers[: len(self._honest_peers) // 2]
 
     def broadcast_proposal(self, h, round, proposal, valid_round):
         """
@@ -61,35 +73,30 @@ class TendermintNodeByzantineCollude(algorithm.TendermintNode):
 
         # We'll lie to first half of honest nodes...
         proposal_alt = algorithm.get_value()
-        honest_nodes = [
-            x for x in self.peers if x not in self.collusion_tracker.byzantine_nodes
-        ]
-        send_alt = honest_nodes[: len(honest_nodes) // 2]
+        send_alt = self._send_alt
 
         for to_node_id in send_alt:
-            msg = {
-                "msg_type": "PROPOSAL",
-                "sender": self.node_id,
-                "h": h,
-                "round": round,
-                "proposal": proposal_alt,
-                "valid_round": valid_round,
-            }
+            msg = messages.Proposal(
+                sender=self.node_id,
+                h=h,
+                round=round,
+                proposal=proposal_alt,
+                valid_round=valid_round,
+            )
             self.message_queue.send_message(to_node_id, msg)
             self.collusion_tracker.store_vote(to_node_id, round, self.id_(proposal_alt))
 
-        msg = {
-            "msg_type": "PROPOSAL",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "proposal": proposal,
-            "valid_round": valid_round,
-        }
+        msg = messages.Proposal(
+            sender=self.node_id,
+            h=h,
+            round=round,
+            proposal=proposal,
+            valid_round=valid_round,
+        )
         for to_node_id in self.peers:
             if to_node_id in send_alt:
                 continue
-            self.message_queue.send_message(to_node_id, dict(msg))
+            self.message_queue.send_message(to_node_id, msg)
             self.collusion_tracker.store_vote(to_node_id, round, self.id_(proposal))
 
         self.process_message(msg)
@@ -97,45 +104,39 @@ class TendermintNodeByzantineCollude(algorithm.TendermintNode):
     def broadcast_prevote(self, h, round, id_v_default):
         for to_node_id in self.peers:
             id_v = self.collusion_tracker.get_idv(to_node_id, round, id_v_default)
-            # copying messages so we can pop the msg_type
-            msg = {
-                "msg_type": "PREVOTE",
-                "sender": self.node_id,
-                "h": h,
-                "round": round,
-                "id_v": id_v,
-            }
+            msg = messages.Prevote(
+                sender=self.node_id,
+                h=h,
+                round=round,
+                id_v=id_v,
+            )
             self.message_queue.send_message(to_node_id, msg)
 
-        msg = {
-            "msg_type": "PREVOTE",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "id_v": id_v_default,
-        }
+        msg = messages.Prevote(
+            sender=self.node_id,
+            h=h,
+            round=round,
+            id_v=id_v_default,
+        )
         self.process_message(msg)
 
     def broadcast_precommit(self, h, round, id_v_default):
         for to_node_id in self.peers:
             id_v = self.collusion_tracker.get_idv(to_node_id, round, id_v_default)
-            # copying messages so we can pop the msg_type
-            msg = {
-                "msg_type": "PRECOMMIT",
-                "sender": self.node_id,
-                "h": h,
-                "round": round,
-                "id_v": id_v,
-            }
+            msg = messages.Precommit(
+                sender=self.node_id,
+                h=h,
+                round=round,
+                id_v=id_v,
+            )
             self.message_queue.send_message(to_node_id, msg)
 
-        msg = {
-            "msg_type": "PRECOMMIT",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "id_v": id_v_default,
-        }
+        msg = messages.Precommit(
+            sender=self.node_id,
+            h=h,
+            round=round,
+            id_v=id_v_default,
+        )
         self.process_message(msg)
 
 
@@ -159,11 +160,7 @@ for i in range(n):
         node = algorithm.TendermintNode(i, n, round_time, mq, mq, verbose)
     nodes[i] = node
 
-for i in range(n):
-    for j in range(n):
-        if i == j:
-            continue
-        nodes[i].add_peer(j)
+algorithm.wire_all(nodes)
 
 for i in nodes:
     # Start them off...
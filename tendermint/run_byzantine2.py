@@ -2,6 +2,7 @@ import string
 import random
 import algorithm
 import message_queue
+import messages
 
 """
 LIVENESS FAILURE EXAMPLE
@@ -20,37 +21,34 @@ class TendermintNodeByzantineRandom(algorithm.TendermintNode):
 
     def broadcast_proposal(self, h, round, _proposal, valid_round):
         # len(8) string is considered invalid
-        proposal = "".join(random.choice(string.ascii_letters) for _ in range(8))
-        msg = {
-            "msg_type": "PROPOSAL",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "proposal": proposal,
-            "valid_round": valid_round,
-        }
+        proposal = "".join(random.choices(string.ascii_letters, k=8))
+        msg = messages.Proposal(
+            sender=self.node_id,
+            h=h,
+            round=round,
+            proposal=proposal,
+            valid_round=valid_round,
+        )
         self.broadcast(msg)
 
     def broadcast_prevote(self, h, round, _id_v):
         id_v = int(random.random() * 1000)
-        msg = {
-            "msg_type": "PREVOTE",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "id_v": id_v,
-        }
+        msg = messages.Prevote(
+            sender=self.node_id,
+            h=h,
+            round=round,
+            id_v=id_v,
+        )
         self.broadcast(msg)
 
     def broadcast_precommit(self, h, round, _id_v):
         id_v = int(random.random() * 1000)
-        msg = {
-            "msg_type": "PRECOMMIT",
-            "sender": self.node_id,
-            "h": h,
-            "round": round,
-            "id_v": id_v,
-        }
+        msg = messages.Precommit(
+            sender=self.node_id,
+            h=h,
+            round=round,
+            id_v=id_v,
+        )
         self.broadcast(msg)
 
 
@@ -69,11 +67,7 @@ for i in range(n):
         node = algorithm.TendermintNode(i, n, round_time, mq, mq, verbose)
     nodes[i] = node
 
-for i in range(n):
-    for j in range(n):
-        if i == j:
-            continue
-        nodes[i].add_peer(j)
+algorithm.wire_all(nodes)
 
 for i in nodes:
     # Start them off...
@@ -13,11 +13,7 @@ for i in range(n):
     node = algorithm.TendermintNode(i, n, round_time, mq, mq, verbose)
     nodes[i] = node
 
-for i in range(n):
-    for j in range(n):
-        if i == j:
-            continue
-        nodes[i].add_peer(j)
+algorithm.wire_all(nodes)
 
 for i in nodes:
     # Start them off...
@@ -0,0 +1,85 @@
+import heapq
+import pytest
+from tendermint import algorithm
+from tendermint import message_queue
+
+
+class MessageQueueCutoff(message_queue.MessageQueue):
+    __slots__ = ("vclock", "last_round", "stop_when_decided")
+
+    def __init__(self, nodes, last_round, stop_when_decided=False):
+        # Virtual clock - rather than sleeping until a scheduled message is due,
+        # we jump the clock forward to it
+        self.vclock = 0
+        super().__init__(nodes, 0)
+        # This will be the last round we process
+        self.last_round = last_round
+        # Stop as soon as every node has decided a block for height 0, rather
+        # than draining the rest of the queue.  Only for tests that can't
+        # decide anything after that anyway
+        self.stop_when_decided = stop_when_decided
+
+    def now(self):
+        return self.vclock
+
+    def run(self):
+        q = self.q
+        process_message = self.process_message
+        stop_when_decided = self.stop_when_decided
+        nodes = self.nodes.values()
+        while q:
+            (ts, message_i, node_ids, message) = heapq.heappop(q)
+            # Might be a scheduled message - advance the clock to it
+            self.vclock = max(self.vclock, ts)
+            for node_id in node_ids:
+                process_message(node_id, message)
+            if stop_when_decided and all(0 in node.decision for node in nodes):
+                return
+
+    def send_time(self, message):
+        # prioritize scheduled messages that are due to run by sending at now()
+        return self.now()
+
+    def send_message(self, node_id, message):
+        if message.round <= self.last_round:
+            super().send_message(node_id, message)
+
+    def send_many(self, node_ids, message):
+        if message.round <= self.last_round:
+            super().send_many(node_ids, message)
+
+    def schedule_message(self, node_id, message, scheduled_time):
+        if message.round <= self.last_round:
+            super().schedule_message(node_id, message, scheduled_time)
+
+
+@pytest.fixture
+def make_cluster():
+    """
+    Returns a function building a cluster of n nodes, each peered with all the
+    others, on a MessageQueueCutoff that stops after last_round.  Nodes are
+    node_cls unless node_cls_for (node_id -> class) says otherwise, and only
+    the nodes in verbose_nodes print.  See MessageQueueCutoff for
+    stop_when_decided.  Returns (nodes, mq), with the rounds left for the test
+    to start
+    """
+
+    def _make(
+        n,
+        last_round,
+        node_cls=algorithm.TendermintNode,
+        node_cls_for=None,
+        verbose_nodes=(),
+        round_time=0.01,
+        stop_when_decided=False,
+    ):
+        node_cls_for = node_cls_for or {}
+        nodes = {}
+        mq = MessageQueueCutoff(nodes, last_round, stop_when_decided)
+        for i in range(n):
+            cls = node_cls_for.get(i, node_cls)
+            nodes[i] = cls(i, n, round_time, mq, mq, verbose=i in verbose_nodes)
+        algorithm.wire_all(nodes)
+        return nodes, mq
+
+    return _make